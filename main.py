@@ -1,9 +1,13 @@
+import os
+import sys
 import asyncio
 import logging
-import re, json
-from typing import List, Dict, Optional
-from playwright.async_api import async_playwright, Page, ElementHandle
-from src.llm.load_model import LoadGemini
+import re
+import orjson
+import hashlib
+from typing import List, Dict, Optional, Tuple
+from playwright.async_api import async_playwright, Page, BrowserContext
+from src.llm.load_model import get_gemini
 
 # Configure logging
 logging.basicConfig(
@@ -12,116 +16,306 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# uvloop speeds up the event loop driving Playwright's traffic; it is not available on Windows
+if sys.platform != "win32":
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        logger.debug("uvloop not installed, using the default asyncio event loop")
+
+# Attributes worth sending to Gemini; everything else (style, data-*, ...) is never read
+_ATTRIBUTE_WHITELIST = ["href", "id", "class", "aria-label", "title"]
+
+# Collects tag, text and whitelisted attributes of every visible anchor/button in one evaluate call.
+# Visibility mirrors Playwright's is_visible(): a non-empty box and no visibility:hidden.
+_EXTRACT_ELEMENTS_JS = """
+    (attributeNames) => Array.from(document.querySelectorAll('a, button'))
+        .filter(el => {
+            if (getComputedStyle(el).visibility !== 'visible') return false;
+            const rect = el.getBoundingClientRect();
+            return rect.width > 0 && rect.height > 0;
+        })
+        .map(el => ({
+            tag: el.tagName.toLowerCase(),
+            content: {
+                text: (el.innerText || '').trim() || '[No Text]',
+                attributes: Object.fromEntries(
+                    attributeNames.filter(name => el.hasAttribute(name)).map(name => [name, el.getAttribute(name)])
+                ),
+                visible: true
+            }
+        }))
+"""
+
+_URL_RE = re.compile(r"https?://[^\s\"]+")
+_FENCE_RE = re.compile(r"^```json|```$", re.MULTILINE)
+
+# Heavy assets the navigator never needs; stylesheets are kept since visibility depends on them
+_BLOCKED_RESOURCE_TYPES = {"image", "media", "font"}
+
+# Static instructions and schema; kept first so the prompt prefix is byte-identical across iterations
+_PROMPT_PREFIX = """
+            Website Elements Analysis:
+            Please analyze the clickable elements listed below and provide:
+            1. The exact element to click on for completing the task
+            2. Any subsequent steps needed
+            3. Confirmation that this is the optimal path
+            4. If you determine that the task has been fully accomplished, set "next_steps": ["exit_now"].
+            
+            Return response as JSON:
+            {
+                "recommended_action": {
+                    "element_tag": "string",
+                    "element_text": "string",
+                    "element_attributes": {},
+                    "confidence": "high|medium|low",
+                    "reasoning": "string"
+                },
+                "next_steps": ["string"],
+                "alternative_paths": ["string"]
+            }
+"""
+
 class WebsiteNavigator:
     def __init__(self):
-        self.gemini_object = LoadGemini()
+        self.gemini_object = get_gemini()
+        self._gemini_is_async = asyncio.iscoroutinefunction(self.gemini_object.gemini_response)
         self.MAX_TRIES=100
-        self.url = None
+        self.DIFF_THRESHOLD = 0.3
+        self._playwright = None
+        self._browser = None
+        self._ctx = None
 
-    async def visit_website(self, prompt: str) -> Optional[Dict]:
+    async def __aenter__(self):
+        """Starts Playwright and a browser context that is reused across prompts."""
+        self._playwright = await async_playwright().start()
+        try:
+            self._browser = await self._launch_browser(self._playwright)
+            self._ctx = await self._browser.new_context()
+        except Exception:
+            await self.__aexit__(None, None, None)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._browser:
+            await self._browser.close()
+            logger.info("Browser closed.")
+        if self._playwright:
+            await self._playwright.stop()
+        self._playwright = self._browser = self._ctx = None
+
+    async def _launch_browser(self, playwright):
+        """Launches Chromium headless unless DEBUG_HEADED is set."""
+        return await playwright.chromium.launch(headless=not os.getenv("DEBUG_HEADED"))
+
+    async def run_many(self, prompts: List[str]) -> List[Optional[Dict]]:
         """
-        Visits a website based on a prompt and extracts clickable elements.
-        Returns navigation instructions from Gemini.
+        Runs several prompts concurrently on one browser, each in its own context
+        so cookies stay isolated. Results are returned in the order of the prompts.
+        Without an entered navigator, a temporary browser is kept local to this call.
         """
+        if self._browser:
+            return await self._run_many_on(self._browser, prompts)
+
         async with async_playwright() as p:
-            browser = None
+            browser = await self._launch_browser(p)
             try:
-                browser = await p.chromium.launch(headless=False, slow_mo=50)
-                page = await browser.new_page()
+                return await self._run_many_on(browser, prompts)
+            finally:
+                await browser.close()
 
-                self.url = self._extract_url_from_prompt(prompt)
-                if not self.url:
-                    raise ValueError("No valid URL found in the prompt.")
+    async def _run_many_on(self, browser, prompts: List[str]) -> List[Optional[Dict]]:
+        semaphore = asyncio.Semaphore(min(os.cpu_count() or 1, 4))
 
-                logger.info(f"Visiting URL: {self.url}")
-                await page.goto(self.url, timeout=30000)
+        async def run_one(index: int, prompt: str):
+            async with semaphore:
+                try:
+                    context = await browser.new_context()
+                except Exception as e:
+                    logger.error(f"Could not create a browser context: {str(e)}")
+                    return index, None
+                try:
+                    return index, await self.visit_website(prompt, context)
+                finally:
+                    await context.close()
 
-                for _ in range(self.MAX_TRIES):
-                    elements = await self._extract_clickable_elements(page)
-                    if not elements:
-                        logger.warning("No clickable elements found on the page")
-                        return None
+        tasks = [asyncio.create_task(run_one(i, prompt)) for i, prompt in enumerate(prompts)]
+        results = [None] * len(prompts)
+        try:
+            for task in asyncio.as_completed(tasks):
+                index, result = await task
+                logger.info(f"Finished prompt {index + 1} of {len(prompts)}")
+                results[index] = result
+        finally:
+            # Never leave tasks running on a browser that is about to be closed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return results
 
-                    processed_tags = await self._process_elements(elements)
-                    
-                    # Handle Gemini response synchronously or asynchronously based on implementation
+    async def visit_website(self, prompt: str, context: Optional[BrowserContext] = None) -> Optional[Dict]:
+        """
+        Visits a website based on a prompt and extracts clickable elements.
+        Returns navigation instructions from Gemini.
+        Without an entered navigator, a temporary browser is kept local to this call.
+        """
+        context = context or self._ctx
+        if not context:
+            try:
+                async with async_playwright() as p:
+                    browser = await self._launch_browser(p)
                     try:
-                        if asyncio.iscoroutinefunction(self.gemini_object.gemini_response):
-                            response = await self.gemini_object.gemini_response(
-                                self._create_gemini_prompt(prompt, processed_tags)
-                            )
-                        else:
-                            response = self.gemini_object.gemini_response(
-                                self._create_gemini_prompt(prompt, processed_tags)
-                            )
-                        check_if_clicked = await self._click_recommended_elements(page, response)
-                        if check_if_clicked:
-                            continue
-                        else:
-                            return False
-                    except Exception as e:
-                        logger.error(f"Error getting Gemini response: {str(e)}")
-                        return None
-
+                        return await self.visit_website(prompt, await browser.new_context())
+                    finally:
+                        await browser.close()
             except Exception as e:
                 logger.error(f"An error occurred: {str(e)}")
                 return None
-            finally:
-                if browser:
-                    await browser.close()
-                    logger.info("Browser closed.")
+
+        page = None
+        try:
+            page = await context.new_page()
+            await page.route("**/*", self._block_heavy_resources)
+
+            url = self._extract_url_from_prompt(prompt)
+            if not url:
+                raise ValueError("No valid URL found in the prompt.")
+
+            logger.info(f"Visiting URL: {url}")
+            await page.goto(url, timeout=30000, wait_until="domcontentloaded")
+            history = {"key": None, "tags": set(), "visited": set()}
+
+            for _ in range(self.MAX_TRIES):
+                processed_tags = self._deduplicate_elements(
+                    await self._extract_clickable_elements(page)
+                )
+                if not processed_tags:
+                    logger.warning("No clickable elements found on the page")
+                    return None
+
+                selection = self._select_changed_elements(page.url, processed_tags, history)
+                if selection is None:
+                    logger.info("Page state already visited in this run, stopping navigation")
+                    return False
+                prompt_tags, only_new = selection
+                unchanged = self._summarize_unchanged(processed_tags, prompt_tags) if only_new else None
+
+                try:
+                    response = await self._ask_gemini(
+                        self._create_gemini_prompt(prompt, prompt_tags, unchanged)
+                    )
+                    check_if_clicked = await self._click_recommended_elements(page, response)
+                    if check_if_clicked:
+                        continue
+                    else:
+                        return False
+                except Exception as e:
+                    logger.error(f"Error getting Gemini response: {str(e)}")
+                    return None
+
+        except Exception as e:
+            logger.error(f"An error occurred: {str(e)}")
+            return None
+        finally:
+            if page:
+                await page.close()
+
+    async def _block_heavy_resources(self, route):
+        """Aborts requests for images, media and fonts."""
+        if route.request.resource_type in _BLOCKED_RESOURCE_TYPES:
+            await route.abort()
+        else:
+            await route.continue_()
+
+    async def _ask_gemini(self, llm_prompt: str) -> str:
+        """
+        Handles Gemini response synchronously or asynchronously based on implementation.
+        A synchronous client runs in a worker thread so it does not block the event loop.
+        """
+        if self._gemini_is_async:
+            return await self.gemini_object.gemini_response(llm_prompt)
+        return await asyncio.to_thread(self.gemini_object.gemini_response, llm_prompt)
 
     def _extract_url_from_prompt(self, prompt: str) -> Optional[str]:
         """Extracts URL from a given prompt with validation."""
-        match = re.search(r"https?://[^\s\"]+", prompt)
-        if not match:
-            return None
-        url = match.group(0)
-        return url if url.startswith(('http://', 'https://')) else None
-
-    async def _extract_clickable_elements(self, page: Page) -> List[ElementHandle]:
-        """Extracts all clickable elements from the page."""
-        elements = await page.query_selector_all("a, button")
-        logger.info(f"Found {len(elements)} clickable elements")
-        return elements
-
-    async def _process_elements(self, elements: List[ElementHandle]) -> List[Dict]:
-        """Processes extracted elements into a structured format."""
-        processed_tags = []
-        for element in elements:
-            try:
-                tag_name = await element.evaluate("el => el.tagName.toLowerCase()")
-                text = (await element.inner_text()).strip()
-                attributes = await element.evaluate(
-                    "el => Object.fromEntries([...el.attributes].map(attr => [attr.name, attr.value]))"
-                )
-                visible = await element.is_visible()
-
-                if visible:  # Only include visible elements
-                    processed_tags.append({
-                        "tag": tag_name,
-                        "content": {
-                            "text": text if text else "[No Text]",
-                            "attributes": attributes,
-                            "visible": visible
-                        }
-                    })
-                    logger.debug(f"Processed element: {tag_name} | Text: {text}")
-            except Exception as e:
-                logger.error(f"Error processing element: {str(e)}")
-                continue
+        match = _URL_RE.search(prompt)
+        return match.group(0) if match else None
 
+    async def _extract_clickable_elements(self, page: Page) -> List[Dict]:
+        """Extracts all visible clickable elements from the page in a single round trip."""
+        processed_tags = await page.evaluate(_EXTRACT_ELEMENTS_JS, _ATTRIBUTE_WHITELIST)
+        logger.info(f"Found {len(processed_tags)} clickable elements")
         return processed_tags
 
+    def _deduplicate_elements(self, processed_tags: List[Dict]) -> List[Dict]:
+        """Drops duplicate elements and elements with neither text nor href."""
+        seen = set()
+        deduplicated = []
+        for tag in processed_tags:
+            content = tag["content"]
+            href = content["attributes"].get("href")
+            if content["text"] == "[No Text]" and not href:
+                continue
+
+            key = (tag["tag"], content["text"], href)
+            if key in seen:
+                continue
+            seen.add(key)
+            deduplicated.append(tag)
+
+        logger.info(f"Kept {len(deduplicated)} of {len(processed_tags)} elements after deduplication")
+        return deduplicated
+
+    def _select_changed_elements(
+        self, page_url: str, processed_tags: List[Dict], history: Dict
+    ) -> Optional[Tuple[List[Dict], bool]]:
+        """
+        Compares the elements with the previous iteration, as recorded in history.
+        Returns None if this page state was already seen during the run (an identical
+        prompt would only replay the cached Gemini answer). Otherwise returns the elements
+        to send and whether they are only the new ones: just the new elements if a small
+        part of the page changed, and the full list otherwise.
+        """
+        serialized = [orjson.dumps(tag, option=orjson.OPT_SORT_KEYS) for tag in processed_tags]
+        page_key = (page_url, hashlib.md5(b"".join(serialized)).digest())
+        if page_key in history["visited"]:
+            return None
+        history["visited"].add(page_key)
+
+        current_tags = set(serialized)
+        new_tags = current_tags - history["tags"]
+        partially_changed = (
+            history["key"] is not None
+            and history["key"][0] == page_url
+            and 0 < len(new_tags) <= self.DIFF_THRESHOLD * len(current_tags)
+        )
+        history["key"] = page_key
+        history["tags"] = current_tags
+
+        if partially_changed:
+            logger.info(f"Sending {len(new_tags)} changed elements to Gemini")
+            return [tag for tag, key in zip(processed_tags, serialized) if key in new_tags], True
+        return processed_tags, False
+
+    def _summarize_unchanged(self, processed_tags: List[Dict], new_tags: List[Dict]) -> List[Dict]:
+        """Reduces the elements that did not change to tag, text and href so they stay selectable cheaply."""
+        new_ids = {id(tag) for tag in new_tags}
+        return [
+            {"tag": tag["tag"], "text": tag["content"]["text"], "href": tag["content"]["attributes"].get("href")}
+            for tag in processed_tags if id(tag) not in new_ids
+        ]
+
     async def _extract_json_from_gemini_response(self, recommended_action:str):
-        clean_json = re.sub(r"^```json|```$", "", recommended_action, flags=re.MULTILINE).strip()
+        clean_json = _FENCE_RE.sub("", recommended_action).strip()
 
         # Parse JSON
-        data = json.loads(clean_json)
+        data = orjson.loads(clean_json)
         return data
 
     async def _click_recommended_elements(self, page: Page, recommended_action: str):
-        logger.info(f"Gemini response \n {recommended_action}")
+        logger.info("Gemini response \n %s", recommended_action)
         recommended_action = await self._extract_json_from_gemini_response(recommended_action)
 
         try:
@@ -136,31 +330,34 @@ class WebsiteNavigator:
             logger.info(f"Attempting to click: {element_text}")
 
             # Extract href safely
-            href = recommended_action['recommended_action']['element_attributes'].get('href')
+            attributes = recommended_action['recommended_action']['element_attributes']
+            href = attributes.get('href')
             next_steps = recommended_action["next_steps"][0]
-            print(logging.info(f"Next steps: {next_steps}"))
-            if not href:
-                logger.error("No href found in element attributes")
+            logger.info("Next steps: %s", next_steps)
+            has_text = bool(element_text) and element_text.strip() != "[No Text]"
+            if not (href or attributes.get('aria-label') or attributes.get('id') or has_text):
+                logger.error("No href, aria-label, id or text to locate the element by")
                 return False
-            
-            logger.info(f"The requested attribute: {href}")
 
-            # Define selector
-            selectors = [
-                f"a[href='{href}']",
-                f"a:has-text('{element_text.strip()}')"  # Alternative selector using text
-            ]
+            if href:
+                logger.info(f"The requested attribute: {href}")
+
+            # Only anchors and buttons are extracted, so anything else falls back to an anchor
+            element_tag = str(recommended_action['recommended_action'].get('element_tag', "")).lower()
+            if element_tag not in ("a", "button"):
+                element_tag = "a"
+            selectors = self._build_click_selectors(element_tag, attributes, element_text)
 
             # Try clicking using each selector
             for selector in selectors:
                 try:
                     await page.click(selector, timeout=5000)
                     logger.info(f"Successfully clicked element using selector: {selector}")
-                    await page.wait_for_timeout(10000)  # Ensure the page loads
-                    
                     if next_steps == "exit_now":
+                        # Final click of the run; nothing reads the page afterwards
                         return False
-                    else: return True
+                    await self._wait_for_page_settle(page)
+                    return True
 
                 except Exception as e:
                     logger.warning(f"Failed to click with selector {selector}: {str(e)}")
@@ -173,41 +370,72 @@ class WebsiteNavigator:
             logger.error(f"Error clicking recommended element: {str(e)}")
             return False
 
-    def _create_gemini_prompt(self, user_prompt: str, tags: List[Dict]) -> str:
-        """Creates a structured response from Gemini."""
-        return f"""
+    def _build_click_selectors(self, element_tag: str, attributes: Dict, element_text: str) -> List[str]:
+        """
+        Builds selectors from the most to the least specific, scoped to the recommended tag.
+        Attribute selectors resolve directly; the has-text fallback has to scan text on every node.
+        """
+        selectors = []
+        if attributes.get('href'):
+            selectors.append(f"a[href={self._css_string(attributes['href'])}]")
+        if attributes.get('aria-label'):
+            selectors.append(f"{element_tag}[aria-label={self._css_string(attributes['aria-label'])}]")
+        if attributes.get('id'):
+            selectors.append(f"{element_tag}[id={self._css_string(attributes['id'])}]")
+        if element_text and element_text.strip() != "[No Text]":
+            # Alternative selector using text
+            selectors.append(f"{element_tag}:has-text({self._css_string(element_text.strip())})")
+        return selectors
+
+    def _css_string(self, value: str) -> str:
+        """Quotes a value for use inside a CSS selector, escaping backslashes and quotes."""
+        escaped = value.replace("\\", "\\\\").replace("'", "\\'")
+        return f"'{escaped}'"
+
+    async def _wait_for_page_settle(self, page: Page, timeout: int = 5000, idle_timeout: int = 1500):
+        """
+        Waits for the DOM to load after a click instead of sleeping.
+        networkidle is best-effort with a shorter cap, since analytics or long-poll
+        traffic can keep it from ever settling.
+        """
+        try:
+            await page.wait_for_load_state("domcontentloaded", timeout=timeout)
+        except Exception as e:
+            logger.warning(f"Page did not reach domcontentloaded: {str(e)}")
+        try:
+            await page.wait_for_load_state("networkidle", timeout=idle_timeout)
+        except Exception as e:
+            logger.debug(f"Page did not reach networkidle: {str(e)}")
+
+    def _create_gemini_prompt(
+        self, user_prompt: str, tags: List[Dict], unchanged: Optional[List[Dict]] = None
+    ) -> str:
+        """
+        Creates a structured response from Gemini.
+        Only the task and element list are formatted; they follow the constant prefix.
+        When unchanged is given, tags holds just the elements that appeared after the last
+        click and unchanged lists the rest of the page by tag, text and href.
+        """
+        if unchanged is None:
+            return f"""{_PROMPT_PREFIX}
             Task: {user_prompt}
-            Website Elements Analysis:
             Found {len(tags)} clickable elements.
-            
-            Please analyze these elements and provide:
-            1. The exact element to click on for completing the task
-            2. Any subsequent steps needed
-            3. Confirmation that this is the optimal path
-            4. If you determine that the task has been fully accomplished, set "next_steps": ["exit_now"].
-            
-            Available elements: {tags}
-            
-            Return response as JSON:
-            {{
-                "recommended_action": {{
-                    "element_tag": "string",
-                    "element_text": "string",
-                    "element_attributes": {{}},
-                    "confidence": "high|medium|low",
-                    "reasoning": "string"
-                }},
-                "next_steps": ["string"],
-                "alternative_paths": ["string"]
-            }}
+            Available elements: {orjson.dumps(tags).decode()}
+        """
+        return f"""{_PROMPT_PREFIX}
+            Task: {user_prompt}
+            Found {len(tags)} clickable elements that newly appeared after the last click,
+            plus {len(unchanged)} unchanged elements listed by tag, text and href only.
+            Available elements: {orjson.dumps(tags).decode()}
+            Unchanged elements: {orjson.dumps(unchanged).decode()}
         """
     
 
 async def main():
     try:
-        navigator = WebsiteNavigator()
         prompt = "Go to https://file-examples.com/ and download the smallest doc file."
-        result = await navigator.visit_website(prompt)
+        async with WebsiteNavigator() as navigator:
+            result = await navigator.visit_website(prompt)
         if result:
             print("\n🤖 Navigation Instructions:")
             print(result)
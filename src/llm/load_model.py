@@ -1,13 +1,20 @@
 import os
-import toml
+import tomllib
 import logging
 import re
+import hashlib
+import functools
+import threading
+import orjson
+from collections import OrderedDict
 from dotenv import load_dotenv
+from pydantic import PrivateAttr
 from langchain_google_genai import GoogleGenerativeAI
 
 # Load environment variables
 load_dotenv()
-config = toml.load("config.toml")
+with open("config.toml", "rb") as f:
+    config = tomllib.load(f)
 
 # Setup logger correctly
 logging.basicConfig(
@@ -18,15 +25,85 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 class LoadGemini(GoogleGenerativeAI):
+    # LRU of prompt hash -> response, so repeated prompts skip the network call
+    _response_cache: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    # Guards the cache when prompts run concurrently in worker threads
+    _cache_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
     def __init__(self):
         model = config["gemini"]["model"]
         gemini_api_key = os.getenv("GEMINI_API_KEY")
         super().__init__(model=model, api_key=gemini_api_key)
 
     def gemini_response(self, query):
-        response = self.invoke(query)
+        key = hashlib.blake2b(query.encode()).hexdigest()
+        with self._cache_lock:
+            if key in self._response_cache:
+                self._response_cache.move_to_end(key)
+                logger.info("Gemini cache hit")
+                return self._response_cache[key]
+
+        response, complete = self._stream_first_json_block(query)
+        if not complete:
+            logger.warning("Gemini response ended without a complete JSON object, not caching it")
+            return response
+
+        with self._cache_lock:
+            self._response_cache[key] = response
+            if len(self._response_cache) > config["gemini"].get("cache_size", 128):
+                self._response_cache.popitem(last=False)
         return response
 
+    def _stream_first_json_block(self, query):
+        """
+        Streams the response and stops reading once a complete JSON object has arrived.
+        Returns the object text and True, or the whole text and False if none was found.
+        """
+        text = ""
+        depth = 0
+        start = None
+        in_string = escaped = False
+        stream = self.stream(query)
+        try:
+            for chunk in stream:
+                offset = len(text)
+                text += chunk
+                for i, char in enumerate(chunk, offset):
+                    if start is None:
+                        # Prose before the object is skipped, including stray braces
+                        if char == "{":
+                            start, depth = i, 1
+                    elif in_string:
+                        if escaped:
+                            escaped = False
+                        elif char == "\\":
+                            escaped = True
+                        elif char == '"':
+                            in_string = False
+                    elif char == '"':
+                        in_string = True
+                    elif char == "{":
+                        depth += 1
+                    elif char == "}":
+                        depth -= 1
+                        if depth == 0:
+                            candidate = text[start:i + 1]
+                            try:
+                                orjson.loads(candidate)
+                                return candidate, True
+                            except orjson.JSONDecodeError:
+                                # Balanced but not JSON (e.g. "{the}"); look for the next object
+                                start = None
+        finally:
+            stream.close()
+        return text, False
+
+
+@functools.lru_cache(maxsize=1)
+def get_gemini() -> LoadGemini:
+    """Returns a shared LoadGemini instance so the client is only built once per process."""
+    return LoadGemini()
+
 
 # gemini_object = LoadGemini()
 # response = gemini_object.gemini_response('''